@@ -1,14 +1,100 @@
 import os
+import re
 import pikepdf
 import logging
+import logging.handlers
+import atexit
+import multiprocessing
 import coloredlogs
 import shutil
 import sys
+import tempfile
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 pdf_password = sys.argv[1]
 working_directory = sys.argv[2]
 backup_directory = "pdf_with_password"
+max_workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+# ioctl request number of FICLONE from linux/fs.h, exposed by fcntl only since 3.12
+FICLONE = getattr(fcntl, "FICLONE", 0x40049409)
+# Every letter case of ".pdf", so names can be matched without lowering them
+PDF_SUFFIXES = (".pdf", ".PDF", ".Pdf", ".pDf", ".pdF", ".PDf", ".PdF", ".pDF")
+# Markers looked for by is_pdf_encrypted; \b keeps /EncryptMetadata out
+PDF_HEADER = b"%PDF-"
+ENCRYPT_RE = re.compile(rb"/Encrypt\b")
+STARTXREF_RE = re.compile(rb"startxref\s+(\d+)")
+# Backup directories already created by this process
+ensured_backup_paths = set()
+
+
+def mask(value: str) -> str:
+    """
+    Mask a sensitive value for logging, without revealing its length.
+
+    :param value: The value to mask.
+    :return: An empty string for an empty value, a fixed placeholder otherwise.
+    """
+    return "" if not value else "***"
+
+
+def copy_file(source: str, destination: str):
+    """
+    Copy a file with its metadata, as a copy-on-write clone when possible.
+
+    :param source: The full path of the file to copy.
+    :param destination: The full path of the copy.
+    """
+    if fcntl is not None and sys.platform.startswith("linux"):
+        try:
+            with open(source, "rb") as src, open(destination, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            shutil.copystat(source, destination)
+            return
+        except OSError:
+            pass
+    shutil.copy2(source, destination)
+
+
+def ensure_backup_path(backup_path: str):
+    """
+    Create the given backup directory unless this process already did.
+
+    :param backup_path: The full path of the backup directory.
+    """
+    if backup_path in ensured_backup_paths:
+        return
+    os.makedirs(backup_path, exist_ok=True)
+    ensured_backup_paths.add(backup_path)
+
+
+def prefetch_file(filepath: str):
+    """
+    Ask the kernel to start loading the given file into the page cache.
+
+    :param filepath: The full path of the file to prefetch.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(filepath, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        # Unlike the access-pattern hints, WILLNEED acts on the page cache
+        # itself, so it still helps once this descriptor is closed.
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
 
 
 def backup_file(file_full_path: str) -> bool:
@@ -23,9 +109,8 @@ def backup_file(file_full_path: str) -> bool:
         file_name = os.path.basename(file_full_path)
         backup_path = os.path.join(file_path, backup_directory)
 
-        if not os.path.exists(backup_path):
-            os.makedirs(backup_path)
-        shutil.copy2(file_full_path, os.path.join(backup_path, file_name))
+        ensure_backup_path(backup_path)
+        copy_file(file_full_path, os.path.join(backup_path, file_name))
         return True
     except:
         mylogs.error("Failed to backup %s it was skipped",
@@ -33,21 +118,64 @@ def backup_file(file_full_path: str) -> bool:
         return False
 
 
-def count_files(directory: str) -> int:
+def list_directory(directory: str, subdirectories: list) -> list:
+    """
+    List the PDF files directly inside the given directory, appending its
+    subdirectories other than backup directories to the given list.
+
+    :param directory: The path of the directory to list.
+    :param subdirectories: The list to append the subdirectories found to.
+    :return: The full paths of the PDF files found.
+    """
+    pdf_files = []
+    found_subdirectories = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name == backup_directory:
+                        mylogs.debug("Backup directory, skipping...")
+                        continue
+                    found_subdirectories.append(entry.path)
+                elif entry.name.endswith(PDF_SUFFIXES) and entry.is_file():
+                    pdf_files.append(entry.path)
+    except OSError:
+        mylogs.error("Failed to list %s it was skipped", directory)
+        return []
+    subdirectories.extend(found_subdirectories)
+    return pdf_files
+
+
+def walk_directory(directory: str) -> list:
     """
-    Count the number of PDF files in the given directory and its subdirectories.
+    Find PDF files in the given directory and its subdirectories.
 
-    :param directory: The path of the directory to count PDF files in.
-    :return: The number of PDF files found.
+    :param directory: The path of the directory to search PDF files in.
+    :return: The full paths of the PDF files found.
     """
-    count = 0
-    for filename in os.listdir(directory):
-        path = os.path.join(directory, filename)
-        if os.path.isfile(path) and path.endswith(".pdf"):
-            count += 1
-        elif os.path.isdir(path) and not path.endswith(backup_directory):
-            count += count_files(path)
-    return count
+    pdf_files = []
+    directories = [directory]
+    while directories:
+        pdf_files.extend(list_directory(directories.pop(), directories))
+    return pdf_files
+
+
+def find_pdfs(directory: str):
+    """
+    Find PDF files in the given directory and its subdirectories, skipping
+    backup directories, walking each top-level subdirectory in parallel.
+
+    :param directory: The path of the directory to search PDF files in.
+    :return: A generator of the full paths of the PDF files found.
+    """
+    subdirectories = []
+    yield from list_directory(directory, subdirectories)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(walk_directory, subdirectory)
+                   for subdirectory in subdirectories]
+        for future in as_completed(futures):
+            yield from future.result()
 
 
 def configure_logging() -> logging.Logger:
@@ -69,9 +197,144 @@ def configure_logging() -> logging.Logger:
     coloredlogs.install(level=logging.DEBUG,
                         logger=mylogs,
                         fmt='[%(asctime)s] [%(levelname)s] %(message)s')
+
+    # Hand records to a background thread so neither this process nor the
+    # worker processes, which log through the same queue, block on the
+    # console or the log file.
+    log_queue = multiprocessing.get_context("spawn").Queue(-1)
+    listener = logging.handlers.QueueListener(
+        log_queue, *mylogs.handlers, *logging.getLogger().handlers,
+        respect_handler_level=True)
+    mylogs.handlers = [logging.handlers.QueueHandler(log_queue)]
+    mylogs.propagate = False
+    listener.start()
+    atexit.register(listener.stop)
     return mylogs
 
 
+def is_pdf_encrypted(filepath: str) -> Optional[bool]:
+    """
+    Tell whether the given PDF file is encrypted from the /Encrypt entry of
+    its trailer, without parsing the file.
+
+    :param filepath: The full path of the PDF file to check.
+    :return: True or False when the trailer settles it, None otherwise.
+    """
+    try:
+        with open(filepath, "rb") as f:
+            start = f.read(2048)
+            # Readers accept junk before the header; offsets then count from
+            # the header, and so does the head scanned below
+            header = start.find(PDF_HEADER, 0, 1024)
+            if header == -1:
+                return None
+            head = start[header:header + 1024]
+            size = f.seek(0, os.SEEK_END)
+            f.seek(max(0, size - 8192))
+            tail = f.read()
+
+            # Linearized files carry their first-page trailer near the start
+            if ENCRYPT_RE.search(head):
+                return True
+            if b"/Linearized" in head:
+                return None
+
+            trailer = tail.rfind(b"trailer")
+            if trailer != -1 and b"startxref" in tail[trailer:]:
+                if ENCRYPT_RE.search(tail, trailer):
+                    return True
+                # Only a complete trailer proves there is no /Encrypt; the
+                # main trailer of a linearized file holds just /Size and /ID
+                return False if b"/Root" in tail[trailer:] else None
+
+            startxref = STARTXREF_RE.findall(tail)
+            if not startxref:
+                return None
+            f.seek(header + int(startxref[-1]))
+            xref = f.read(4096)
+    except (OSError, ValueError):
+        return None
+
+    stream = xref.find(b"stream")
+    if stream == -1 or b"/XRef" not in xref[:stream]:
+        return None
+    if ENCRYPT_RE.search(xref, 0, stream):
+        return True
+    return False if b"/Root" in xref[:stream] else None
+
+
+def unlock_file(filepath: str, password: str):
+    """
+    Remove the password of the given PDF file, replacing it in place.
+
+    :param filepath: The full path of the PDF file to unlock.
+    :param password: The password to open the PDF file with.
+    """
+    temp_path = None
+    try:
+        with pikepdf.open(filepath, password=password) as pdf:
+            # Not a .pdf name, so a copy left behind by a killed run is
+            # never picked up as input by the next one
+            fd, temp_path = tempfile.mkstemp(
+                suffix=".tmp", dir=os.path.dirname(filepath))
+            with os.fdopen(fd, "wb") as output:
+                # Only the encryption is being removed: pass stream data
+                # through as-is instead of decoding and recompressing it.
+                pdf.save(output,
+                         stream_decode_level=pikepdf.StreamDecodeLevel.none)
+        shutil.copymode(filepath, temp_path)
+        os.replace(temp_path, filepath)
+    except BaseException:
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def init_worker(log_queue):
+    """
+    Send the log records of a worker process to the main process.
+
+    :param log_queue: The queue the main process' log listener reads from.
+    """
+    global mylogs
+    mylogs = logging.getLogger(__name__)
+    mylogs.setLevel(logging.DEBUG)
+    mylogs.handlers = [logging.handlers.QueueHandler(log_queue)]
+    mylogs.propagate = False
+
+
+def process_file(filepath: str, nb: int):
+    """
+    Attempt to remove the password of the given PDF file, backing it up
+    first. Files that open without a password are left untouched.
+
+    :param filepath: The full path of the PDF file to process.
+    :param nb: The position of the file in the processing order, for logging.
+    """
+    file = os.path.basename(filepath)
+    mylogs.info("%s) File processing: %s (%s)", nb, file, filepath)
+
+    if is_pdf_encrypted(filepath) is False:
+        mylogs.info("%s isn't locked with a password", file)
+        return
+
+    try:
+        with pikepdf.open(filepath):
+            mylogs.info("%s isn't locked with a password", file)
+    except pikepdf.PasswordError:
+        if backup_file(filepath):
+            mylogs.info("%s was backed up", file)
+
+        prefetch_file(filepath)
+        try:
+            unlock_file(filepath, str(pdf_password))
+            mylogs.info("Successfully removed password on %s", file)
+        except pikepdf.PasswordError:
+            mylogs.error("Bad password for %s", file)
+        except:
+            mylogs.error("Failed to remove password on %s", file)
+
+
 def process_files(working_directory: str):
     """
     Process all PDF files in the working directory and its subdirectories,
@@ -79,46 +342,43 @@ def process_files(working_directory: str):
 
     :param working_directory: The path of the directory to process PDF files in.
     """
-    nb = 0
-
-    for subdir, _, files in os.walk(working_directory):
-        if subdir.endswith(backup_directory):
-            mylogs.debug("Backup directory, skipping...")
-            continue
-
-        for file in files:
-            filepath = os.path.join(subdir, file)
-            if filepath.endswith(".pdf"):
-                nb += 1
-                mylogs.info(f"{nb}) File processing: {file} ({filepath})")
-
-                if backup_file(filepath):
-                    mylogs.info(f"{file} was backed up")
-
-                try:
-                    pdf = pikepdf.open(filepath)
-                    mylogs.info(f"{file} isn't locked with a password")
-                except pikepdf.PasswordError:
-                    try:
-                        pdf = pikepdf.open(filepath, password=str(
-                            pdf_password), allow_overwriting_input=True)
-                        pdf.save(filepath)
-                        mylogs.info(f"Successfully removed password on {file}")
-                    except pikepdf.PasswordError:
-                        mylogs.error(f"Bad password for {file}")
-                    except:
-                        mylogs.error(f"Failed to remove password on {file}")
-
-
-if __name__ == "main":
+    pdf_files = list(find_pdfs(working_directory))
+
+    mylogs.info("Number of files to process: %s", str(len(pdf_files)))
+    mylogs.info("_" * 50)
+
+    log_queue = mylogs.handlers[0].queue
+    executor = ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(log_queue,))
+    try:
+        futures = {executor.submit(process_file, filepath, nb): filepath
+                   for nb, filepath in enumerate(pdf_files, start=1)}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as error:
+                mylogs.error("Failed to process %s it was skipped: %s",
+                             os.path.basename(futures[future]), error)
+    except KeyboardInterrupt:
+        mylogs.warning("Interrupted, the remaining files were skipped")
+        # Cancel here rather than leave it to the executor's manager thread,
+        # which skips it once the executor has been garbage collected
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+        return
+    executor.shutdown()
+
+
+if __name__ == "__main__":
     mylogs = configure_logging()
     mylogs.info("Starting script %s", os.path.basename(__file__))
     mylogs.info("Current directory: %s", os.getcwd())
     mylogs.info("Working directory: %s", working_directory)
-    mylogs.info("Number of files to process: %s",
-                str(count_files(working_directory)))
-    mylogs.info("Password to remove: %s", pdf_password)
-    mylogs.info("_" * 50)
+    mylogs.info("Password to remove: %s", mask(pdf_password))
 
     process_files(working_directory)
 